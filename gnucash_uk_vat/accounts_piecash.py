@@ -15,6 +15,8 @@ import piecash
 import json
 import math
 
+from sqlalchemy.orm import joinedload
+
 # Wrapper for GnuCash accounts.
 class Accounts:
 
@@ -42,8 +44,14 @@ class Accounts:
             for v in childs:
                 splits.extend(self.get_splits(v, start, end))
 
-        # Iterate over split list
-        for spl in acct.splits:
+        # Iterate over split list.  Transactions are loaded in the same
+        # query as the splits, rather than one query per split when
+        # spl.transaction is accessed.
+        query = self.book.session.query(piecash.Split).filter(
+            piecash.Split.account == acct
+        ).options(joinedload(piecash.Split.transaction))
+
+        for spl in query:
             tx = spl.transaction
             dt = tx.post_date
 
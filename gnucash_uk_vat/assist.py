@@ -867,32 +867,44 @@ class Collector(threading.Thread):
         self.coll = hmrc.AuthCollector("localhost", port)
         self.running = True
 
-    async def collect(self):
-        
-        await self.coll.start()
-        while True:
+        # The loop is created here so that stop() can reach it from another
+        # thread at any time.
+        self.loop = asyncio.new_event_loop()
 
-            if not self.running: return
+    async def collect(self):
 
-            if self.coll.result != None:
-                break
+        await self.coll.start()
 
-            await asyncio.sleep(0.2)
+        # Wait for the browser to come back, or for stop()
+        if self.running:
+            await self.coll.done.wait()
 
-            # asd
+        if self.coll.result == None:
+            await self.coll.stop()
+            return
 
         await self.ui.vat.get_auth(self.coll.result["code"])
 
+        # The session belongs to this thread's event loop, which is about
+        # to go away
+        await self.ui.vat.close()
+
         GLib.idle_add(self.ui.got_auth)
         await self.coll.stop()
 
     def run(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.collect())
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.collect())
 
-    def stop(self):
+    # Runs in the collector's loop.  The collector may not have started
+    # waiting yet, in which case running stops it from doing so.
+    def cancel(self):
         self.running = False
+        if self.coll.done != None:
+            self.coll.done.set()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.cancel)
 
 # Entry point, runs the assist
 def run(config, auth):
@@ -907,5 +919,9 @@ def run(config, auth):
 
     Gtk.main()
     coll.stop()
+
+    # Close API client connections made on the event loop thread
+    asyncio.run_coroutine_threadsafe(ui.vat.close(), loop=evloop).result()
+
     el.stop()
 
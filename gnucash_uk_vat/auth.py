@@ -1,6 +1,6 @@
 
 import json
-from datetime import datetime
+from datetime import datetime, timezone
 
 # Authentication object.  Supports loading from file as JSON, writing back
 # updated auth, and refresh
@@ -36,6 +36,9 @@ class Auth:
         if "expires" not in self.auth:
             raise RuntimeError("No token expiry.  Have you authenticated?")
         expires = datetime.fromisoformat(self.auth["expires"])
-        if  datetime.utcnow() > expires:
+        # Older auth files have naive expiry times, which are UTC
+        if expires.tzinfo == None:
+            expires = expires.replace(tzinfo=timezone.utc)
+        if  datetime.now(timezone.utc) > expires:
             await self.refresh(svc)
 
@@ -4,13 +4,60 @@ import aiohttp
 import aiohttp.web
 import time
 import asyncio
-from datetime import datetime, timedelta, date
-import requests
+from datetime import datetime, timedelta, date, timezone
 import json
 import hashlib
+import random
+import collections
+from email.utils import parsedate_to_datetime
 
 from . model import *
 
+# orjson is used for JSON request and response bodies if it is installed,
+# it is much faster than the json module.
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+# ijson, if installed, parses long response arrays as they arrive
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# HTTP statuses which are worth retrying: rate limiting and transient
+# gateway/server errors.
+retry_statuses = frozenset([429, 502, 503, 504])
+
+# Statuses which are retried for requests which mustn't be repeated once
+# the server has acted on them: VAT return submission, and token exchanges
+# (authorisation codes and refresh tokens can only be used once).  A
+# gateway error doesn't say whether the request got through, but a 429
+# means it was turned away unprocessed.
+unprocessed_statuses = frozenset([429])
+
+# Retry attempts after the first request, base backoff in seconds, random
+# jitter added to each wait, and the cap on any single wait.
+max_retries = 5
+retry_backoff = 1.0
+retry_jitter = 0.5
+max_retry_delay = 30
+
+# Client-side rate limit: no more than rate_limit requests are started in
+# any rate_window seconds.  HMRC allows 3 requests per second per user per
+# application, and answers anything above that with 429.
+rate_limit = 3
+rate_window = 1.0
+
+# Access tokens which expire within this time are refreshed in the
+# background, while the current token is still used.
+token_refresh_margin = 5 * 60
+
 # AuthCollector is a class which provides a temporary web service in order
 # to receive OAUTH credential tokens
 class AuthCollector:
@@ -19,12 +66,16 @@ class AuthCollector:
     def __init__(self, host, port):
         self.host = host
         self.port = port
-        self.running = True
         self.result = None
+        self.done = None
 
     # Main body coroutine
     async def start(self):
 
+        # Set when a result arrives.  Created here, as the constructor may
+        # not run in the event loop.
+        self.done = asyncio.Event()
+
         # Handler, there is only one endpoint, it receives credential
         # tokens
         async def handler(req):
@@ -37,7 +88,7 @@ class AuthCollector:
                 }
 
             # Stops the web server
-            self.running = False
+            self.done.set()
 
             # Send response, which appears in the browser.
             return aiohttp.web.Response(
@@ -62,9 +113,8 @@ class AuthCollector:
 
         await self.start()
 
-        # Sleep until we have a result
-        while self.running:
-            await asyncio.sleep(0.2)
+        # Wait until we have a result
+        await self.done.wait()
 
         await self.stop()
 
@@ -74,15 +124,202 @@ class AuthCollector:
 # VAT API client implementation
 class Vat:
 
+    # Production API endpoints.  Subclasses override these to talk to other
+    # environments.
+    oauth_base = 'https://www.tax.service.gov.uk'
+    api_base = 'https://api.service.hmrc.gov.uk'
+
     # Constructor
     def __init__(self, config, auth, user=None):
         self.config = config
         self.auth = auth
         self.user = user
 
-        # Production API endpoints
-        self.oauth_base = 'https://www.tax.service.gov.uk'
-        self.api_base = 'https://api.service.hmrc.gov.uk'
+        # HTTP client sessions, one per event loop, so that connections
+        # are kept alive and reused across API and OAuth token calls
+        self.sessions = {}
+
+        # In-flight token refresh, per event loop like sessions, shared by
+        # all callers on that loop.  A task can only be awaited from the
+        # loop it was created on.
+        self.refresh_tasks = {}
+
+        # In-flight refresh token requests, by (event loop, refresh token)
+        self.token_requests = {}
+
+        # Rate limiting state, see throttle: start times of recent and
+        # scheduled requests (time.monotonic), and a time before which no
+        # request may start, from a Retry-After or backoff.
+        self.sent = collections.deque()
+        self.blocked_until = 0
+
+        # Parsed token expiry, the same as a time.time() value, and the
+        # string they were parsed from
+        self.expiry = None
+        self.deadline = None
+        self.expiry_str = None
+
+        # Fraud API headers built from config, see build_fraud_headers
+        self.static_fraud_headers = None
+
+    # Get the HTTP client session for the running event loop, creating it
+    # on first use.  A session can't be shared between event loops, and the
+    # assistant makes calls from more than one.
+    async def get_session(self):
+        loop = asyncio.get_running_loop()
+        session = self.sessions.get(loop)
+        if session == None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(sock_connect=5, sock_read=30),
+                json_serialize=json_dumps
+            )
+            self.sessions[loop] = session
+        return session
+
+    # Close the HTTP client session for the running event loop
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        task = self.refresh_tasks.pop(loop, None)
+        if task != None:
+            # Let a background refresh finish writing the new token
+            await asyncio.gather(task, return_exceptions=True)
+        session = self.sessions.pop(loop, None)
+        if session != None:
+            await session.close()
+
+    # Access token expiry time as an aware UTC datetime, or None if not
+    # known.  Only re-parsed when the stored expiry changes, which also
+    # updates self.deadline.  Older auth files have naive expiry times,
+    # which are UTC.
+    def token_expiry(self):
+        try:
+            expires = self.auth.get("expires")
+        except KeyError:
+            return None
+        if expires != self.expiry_str:
+            expiry = None
+            deadline = None
+            if expires != None:
+                expiry = datetime.fromisoformat(expires)
+                if expiry.tzinfo == None:
+                    expiry = expiry.replace(tzinfo=timezone.utc)
+                deadline = expiry.timestamp()
+            self.expiry = expiry
+            self.deadline = deadline
+            self.expiry_str = expires
+        return self.expiry
+
+    # Refresh the access token, unless another caller already refreshed it
+    # while this one was waiting.
+    async def refresh_auth(self):
+        self.token_expiry()
+        if time.time() + token_refresh_margin < self.deadline:
+            return
+        await self.auth.refresh(self)
+
+    # Start a token refresh, or return the one already in flight on the
+    # running event loop
+    def start_refresh(self):
+        loop = asyncio.get_running_loop()
+        task = self.refresh_tasks.get(loop)
+        if task == None or task.done():
+            task = asyncio.create_task(self.refresh_auth())
+            self.refresh_tasks[loop] = task
+        return task
+
+    # Called before each API request.  An expired token is refreshed before
+    # continuing.  One close to expiry is refreshed in the background, so the
+    # request goes ahead with the current token and doesn't wait.  Failures
+    # of a background refresh are reported when the token actually expires.
+    # The check is against wall-clock time rather than time.monotonic(), as
+    # the expiry is a wall-clock time and monotonic time doesn't count
+    # while the machine is suspended.
+    async def ensure_token(self):
+        if self.token_expiry() == None: return
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            await self.start_refresh()
+        elif remaining <= token_refresh_margin:
+            task = self.start_refresh()
+            task.add_done_callback(
+                lambda t: t.cancelled() or t.exception()
+            )
+
+    # Work out how long to wait before retry number 'attempt' (from 0).
+    # A Retry-After header, either seconds or an HTTP date, takes priority
+    # over exponential backoff.
+    @staticmethod
+    def retry_delay(attempt, retry_after=None):
+        delay = None
+        if retry_after != None:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    when = parsedate_to_datetime(retry_after)
+                    delay = (when - datetime.now(when.tzinfo)).total_seconds()
+                except (TypeError, ValueError):
+                    pass
+        if delay == None:
+            delay = retry_backoff * (2 ** attempt)
+            delay += random.uniform(0, retry_jitter)
+        return min(max(delay, 0), max_retry_delay)
+
+    # Wait for a slot to send a request, so that the rate limit is kept and
+    # no request starts before blocked_until.  Each caller reserves its
+    # start time before sleeping, so concurrent callers queue behind each
+    # other without a lock.
+    async def throttle(self):
+        now = time.monotonic()
+        sent = self.sent
+        while sent and sent[0] <= now - rate_window:
+            sent.popleft()
+        start = max(now, self.blocked_until)
+        if len(sent) >= rate_limit:
+            start = max(start, sent[-rate_limit] + rate_window)
+        sent.append(start)
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    # Issue a request using send (client.get, client.post etc.), retrying
+    # with backoff on the statuses in retry_on.  A retry delay holds back
+    # every request from this client, not just the retried one.  Returns
+    # the final status and decoded JSON body, or for a successful response,
+    # the result of read(resp) if given.  Error bodies which aren't JSON
+    # come back as None.
+    async def request(self, send, url, read=None, retry_on=retry_statuses,
+                      **kwargs):
+        attempt = 0
+        while True:
+            await self.throttle()
+            async with send(url, **kwargs) as resp:
+                status = resp.status
+                if status in retry_on and attempt < max_retries:
+                    delay = self.retry_delay(
+                        attempt, resp.headers.get("Retry-After")
+                    )
+                    self.blocked_until = max(
+                        self.blocked_until, time.monotonic() + delay
+                    )
+                elif read != None and status < 400:
+                    return status, await read(resp)
+                else:
+                    try:
+                        obj = await resp.json(loads=json_loads)
+                    except Exception:
+                        if status < 400: raise
+                        obj = None
+                    return status, obj
+            attempt += 1
+
+    # Error message for a failed API response
+    @staticmethod
+    def error_message(status, obj):
+        try:
+            return obj["message"]
+        except:
+            return "HTTP error %d" % status
 
     # Get an auth code
     async def get_code(self):
@@ -169,29 +406,39 @@ class Vat:
             'Content-Type': 'application/x-www-form-urlencoded',
         }
 
-        now = datetime.utcnow()
+        now = datetime.now(timezone.utc)
 
         # Issue request
-        async with aiohttp.ClientSession() as client:
-            async with client.post(url, headers=headers, data=params) as resp:
-                res = await resp.json()
+        client = await self.get_session()
+        status, res = await self.request(client.post, url, headers=headers,
+                                         data=params,
+                                         retry_on=unprocessed_statuses)
 
-        # Turn expiry period into a datetime
+        # Turn expiry period into a datetime, stored to the second
         expiry = now + timedelta(seconds=int(res["expires_in"]))
-        expiry = expiry.replace(microsecond=0)
 
         # Return credentials
         return {
             "access_token": res["access_token"],
             "refresh_token": res["refresh_token"],
             "token_type": res["token_type"],
-            "expires": expiry.isoformat()
+            "expires": expiry.isoformat(timespec="seconds")
         }
 
     # Called to refresh credentials, re-issue auth request from refresh
-    # token
+    # token.  Concurrent calls with the same refresh token share one
+    # request; issuing it twice would waste a round trip, and the second
+    # may be rejected as the first has used up the refresh token.
     async def refresh_token(self, refresh):
-        return await self.refresh_token_coro(refresh)
+        key = (asyncio.get_running_loop(), refresh)
+        task = self.token_requests.get(key)
+        if task == None:
+            task = asyncio.create_task(self.refresh_token_coro(refresh))
+            self.token_requests[key] = task
+            task.add_done_callback(
+                lambda t: self.token_requests.pop(key, None)
+            )
+        return await asyncio.shield(task)
 
     # Co-routine implementation of refresh
     async def refresh_token_coro(self, refresh):
@@ -214,25 +461,34 @@ class Vat:
             'Content-Type': 'application/x-www-form-urlencoded',
         }
 
-        now = datetime.utcnow()
+        now = datetime.now(timezone.utc)
 
-        async with aiohttp.ClientSession() as client:
-            async with client.post(url, headers=headers, data=params) as resp:
-                res = await resp.json()
+        client = await self.get_session()
+        status, res = await self.request(client.post, url, headers=headers,
+                                         data=params,
+                                         retry_on=unprocessed_statuses)
 
         expiry = now + timedelta(seconds=int(res["expires_in"]))
-        expiry = expiry.replace(microsecond=0)
 
         return {
             "access_token": res["access_token"],
             "refresh_token": res["refresh_token"],
             "token_type": res["token_type"],
-            "expires": expiry.isoformat()
+            "expires": expiry.isoformat(timespec="seconds")
         }
 
-    # Constructs HTTP headers which meet the Fraud API.  Most of this
-    # comes from config
+    # Constructs HTTP headers which meet the Fraud API.  All but the
+    # Authorization header come from config and don't change, so they are
+    # built and checked once, on first use.
     def build_fraud_headers(self):
+        if self.static_fraud_headers == None:
+            self.static_fraud_headers = self.build_static_fraud_headers()
+        headers = dict(self.static_fraud_headers)
+        headers['Authorization'] = 'Bearer %s' % self.auth.get("access_token")
+        return headers
+
+    # The Fraud API headers which come from config
+    def build_static_fraud_headers(self):
 
         mac = quote_plus(self.config.get("identity.mac-address"))
 
@@ -284,11 +540,11 @@ class Vat:
             'Gov-Vendor-Product-Name': '%s' % product_name,
             'Gov-Vendor-License-Ids': '%s=%s' % (product_name, hashed_license_id ),
             'Gov-Client-Multi-Factor': '',
-            'Authorization': 'Bearer %s' % self.auth.get("access_token"),
         }
 
     # Test fraud headers.  Only available in Sandbox, not production
     async def test_fraud_headers(self):
+        await self.ensure_token()
         headers = self.build_fraud_headers()
         headers['Accept'] = 'application/vnd.hmrc.1.0+json'
         
@@ -298,44 +554,66 @@ class Vat:
 
         url = self.api_base + '/test/fraud-prevention-headers/validate'
 
-        async with aiohttp.ClientSession() as client:
-            async with client.get(url, headers=headers) as resp:
-                if resp.status != 200:
-                    try:
-                        msg = (await resp.json())["message"]
-                    except:
-                        msg = "HTTP error %d" % resp.status
-                    raise RuntimeError(msg)
-
-                obj = await resp.json()
+        client = await self.get_session()
+        status, obj = await self.request(client.get, url, headers=headers)
+        if status != 200:
+            raise RuntimeError(self.error_message(status, obj))
 
         return obj
 
-    # API request, fetch obligations which are in state O.
-    async def get_open_obligations(self, vrn):
+    # Path of a VAT resource for a VRN, relative to the API base
+    @staticmethod
+    def vat_path(vrn, suffix):
+        return f"/organisations/vat/{vrn}{suffix}"
+
+    # GET an API resource, path is relative to the API base.  Returns the
+    # decoded JSON, or the result of read(resp) if given.  Reads share the
+    # client session, so independent calls can be run together with
+    # asyncio.gather.
+    async def get_json(self, path, params=None, read=None):
+
+        await self.ensure_token()
 
         headers = self.build_fraud_headers()
         headers['Accept'] = 'application/vnd.hmrc.1.0+json'
 
-        params = {
-            "status": "O"
-        }
+        url = self.api_base + path
+        if params:
+            url += "?" + urlencode(params)
 
-        url = self.api_base + '/organisations/vat/%s/obligations?%s' % (
-            vrn,
-            urlencode(params)
-        )
+        client = await self.get_session()
+        status, obj = await self.request(client.get, url, read=read,
+                                         headers=headers)
+        if status != 200:
+            raise RuntimeError(self.error_message(status, obj))
 
-        async with aiohttp.ClientSession() as client:
-            async with client.get(url, headers=headers) as resp:
-                if resp.status != 200:
-                    try:
-                        msg = (await resp.json())["message"]
-                    except:
-                        msg = "HTTP error %d" % resp.status
-                    raise RuntimeError(msg)
+        return obj
+
+    # GET an API resource whose response is an object holding an array
+    # under key, and return the array items converted with conv.  With
+    # ijson, items are converted as the response arrives, rather than
+    # holding the whole body and its decoded tree in memory at once.
+    async def get_items(self, path, params, key, conv):
+
+        # A response without the key is an error, not an empty list, so
+        # the ijson path raises KeyError the same way as obj[key] does.
+        async def read(resp):
+            if ijson == None:
+                obj = await resp.json(loads=json_loads)
+                return [conv(v) for v in obj[key]]
+            async for items in ijson.items(resp.content, key,
+                                           use_float=True):
+                return [conv(v) for v in items]
+            raise KeyError(key)
+
+        return await self.get_json(path, params, read)
 
-                obj = await resp.json()
+    # API request, fetch obligations which are in state O.
+    async def get_open_obligations(self, vrn):
+
+        obj = await self.get_json(
+            self.vat_path(vrn, "/obligations?status=O")
+        )
 
         if "obligations" not in obj:
             raise RuntimeError(obj["message"])
@@ -355,30 +633,15 @@ class Vat:
         if end == None:
             end = datetime.utcnow()
 
-        headers = self.build_fraud_headers()
-        headers['Accept'] = 'application/vnd.hmrc.1.0+json'
-
         params = {
             "from": start.strftime("%Y-%m-%d"),
             "to": end.strftime("%Y-%m-%d")
         }
 
-        url = self.api_base + '/organisations/vat/%s/obligations?%s' % (
-            vrn,
-            urlencode(params)
+        obj = await self.get_json(
+            self.vat_path(vrn, "/obligations"), params
         )
 
-        async with aiohttp.ClientSession() as client:
-            async with client.get(url, headers=headers) as resp:
-                if resp.status != 200:
-                    try:
-                        msg = (await resp.json())["message"]
-                    except:
-                        msg = "HTTP error %d" % resp.status
-                    raise RuntimeError(msg)
-
-                obj = await resp.json()
-
         if "obligations" not in obj:
             raise RuntimeError(obj["message"])
 
@@ -389,55 +652,40 @@ class Vat:
     # API request, fetch a VAT return instance.
     async def get_vat_return(self, vrn, period):
 
-        headers = self.build_fraud_headers()
-        headers['Accept'] = 'application/vnd.hmrc.1.0+json'
-
-#        params = {
-#            "periodKey": period
-#        }
-
-        url = self.api_base + '/organisations/vat/%s/returns/%s' % (
-            vrn, 
-            quote_plus(period)
-        )
-
-        async with aiohttp.ClientSession() as client:
-            async with client.get(url, headers=headers) as resp:
-                if resp.status != 200:
-                    try:
-                        msg = (await resp.json())["message"]
-                    except:
-                        msg = "HTTP error %d" % resp.status
-                        
-                    print("url: %s" % url)
-                    raise RuntimeError(msg)
+        path = self.vat_path(vrn, "/returns/" + quote_plus(period))
 
-                obj = await resp.json()
+        try:
+            obj = await self.get_json(path)
+        except RuntimeError:
+            print("url: %s" % (self.api_base + path))
+            raise
 
         return Return.from_dict(obj)
 
     # API request, submit a VAT return.
     async def submit_vat_return(self, vrn, rtn):
 
-        headers = self.build_fraud_headers()
-        headers['Accept'] = 'application/vnd.hmrc.1.0+json'
+        # HMRC rejects a return with any box missing, so check before
+        # spending a round trip on it
+        if rtn.periodKey == None:
+            raise RuntimeError("VAT return has no period key")
+        for name in vat_fields:
+            if getattr(rtn, name) == None:
+                raise RuntimeError("VAT return box '%s' is not set" % name)
 
-        url = self.api_base + '/organisations/vat/%s/returns' % (
-            vrn
-        )
+        await self.ensure_token()
 
-        async with aiohttp.ClientSession() as client:
-            async with client.post(url, headers=headers,
-                                   json=rtn.to_dict()) as resp:
-                if resp.status != 201:
-                    try:
-                        msg = (await resp.json())["message"]
-                    except:
-                        msg = "HTTP error %d" % resp.status
+        headers = self.build_fraud_headers()
+        headers['Accept'] = 'application/vnd.hmrc.1.0+json'
 
-                    raise RuntimeError(msg)
+        url = self.api_base + self.vat_path(vrn, "/returns")
 
-                obj = await resp.json()
+        client = await self.get_session()
+        status, obj = await self.request(client.post, url, headers=headers,
+                                         json=rtn.to_dict(),
+                                         retry_on=unprocessed_statuses)
+        if status != 201:
+            raise RuntimeError(self.error_message(status, obj))
 
         if "code" in obj:
             raise RuntimeError(obj["message"])
@@ -447,91 +695,54 @@ class Vat:
     # Get liabilities in time period
     async def get_vat_liabilities(self, vrn, start, end):
 
-        headers = self.build_fraud_headers()
-        headers['Accept'] = 'application/vnd.hmrc.1.0+json'
-
         params = {
             "from": start.strftime("%Y-%m-%d"),
             "to": end.strftime("%Y-%m-%d")
         }
 
-        url = self.api_base + '/organisations/vat/%s/liabilities?%s' % (
-            vrn,
-            urlencode(params)
-        )
-
-        async with aiohttp.ClientSession() as client:
-            async with client.get(url, headers=headers) as resp:
-                if resp.status != 200:
-                    try:
-                        msg = (await resp.json())["message"]
-                    except:
-                        msg = "HTTP error %d" % resp.status
-
-                    app_args = {
-                        "start": start.strftime("%Y-%m-%d"),
-                        "end": end.strftime("%Y-%m-%d")
-                    }
-                    print("arguments: %s" % json.dumps(app_args))
-
-                    raise RuntimeError(msg)
-
-                obj = await resp.json()
-
-        return [Liability.from_dict(v) for v in obj["liabilities"]]
+        try:
+            return await self.get_items(
+                self.vat_path(vrn, "/liabilities"), params,
+                "liabilities", Liability.from_dict
+            )
+        except RuntimeError:
+            app_args = {
+                "start": params["from"],
+                "end": params["to"]
+            }
+            print("arguments: %s" % json.dumps(app_args))
+            raise
 
     # Get payments in time period
     async def get_vat_payments(self, vrn, start, end):
 
-        headers = self.build_fraud_headers()
-        headers['Accept'] = 'application/vnd.hmrc.1.0+json'
-
         params = {
             "from": start.strftime("%Y-%m-%d"),
             "to": end.strftime("%Y-%m-%d")
         }
 
-        url = self.api_base + '/organisations/vat/%s/payments?%s' % (
-            vrn,
-            urlencode(params)
-        )
-
-        async with aiohttp.ClientSession() as client:
-            async with client.get(url, headers=headers) as resp:
-
-                if resp.status != 200:
-                    try:
-                        msg = (await resp.json())["message"]
-                    except:
-                        msg = "HTTP error %d" % resp.status
-
-                    app_args = {
-                        "start": start.strftime("%Y-%m-%d"),
-                        "end": end.strftime("%Y-%m-%d")
-                    }
-                    print("arguments: %s" % json.dumps(app_args))
-                    raise RuntimeError(msg)
-
-                obj = await resp.json()
-
-        return [
-            Payment.from_dict(v) for v in obj["payments"]
-        ]
+        try:
+            return await self.get_items(
+                self.vat_path(vrn, "/payments"), params,
+                "payments", Payment.from_dict
+            )
+        except RuntimeError:
+            app_args = {
+                "start": params["from"],
+                "end": params["to"]
+            }
+            print("arguments: %s" % json.dumps(app_args))
+            raise
 
 # Like VAT, but talks to test API endpoints.
 class VatTest(Vat):
-    def __init__(self, config, auth, user):
-    
-        super().__init__(config, auth, user)
-        self.oauth_base = 'https://test-www.tax.service.gov.uk'
-        self.api_base = 'https://test-api.service.hmrc.gov.uk'
+    oauth_base = 'https://test-www.tax.service.gov.uk'
+    api_base = 'https://test-api.service.hmrc.gov.uk'
 
 # Like VAT, but talks to an API endpoints on localhost:8080.
 class VatLocalTest(Vat):
-    def __init__(self, config, auth, user):
-        super().__init__(config, auth, user)
-        self.oauth_base = 'http://localhost:8080'
-        self.api_base = 'http://localhost:8080'
+    oauth_base = 'http://localhost:8080'
+    api_base = 'http://localhost:8080'
 
 def create(config, auth, user):
 
@@ -1,8 +1,26 @@
 
 import json
-from datetime import datetime, timedelta
+import operator
+from datetime import datetime, timedelta, date, timezone
 
-vat_fields = [
+# orjson is used to decode and encode VAT data if it is installed, it is
+# much faster than the json module.
+try:
+    import orjson
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    orjson = None
+    _json_dumps = json.dumps
+
+# ijson, if installed, reads data files one VRN at a time
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# The 9 VAT return boxes, in box order.  A tuple, as this is constant.
+vat_fields = (
 
     # VAT due on sales and other outputs. This corresponds to box 1 on the VAT
     # Return form.
@@ -44,7 +62,7 @@ vat_fields = [
     # Return form.
     "totalAcquisitionsExVAT"
 
-]
+)
 
 vat_descriptions = {
     "vatDueSales": "VAT due on sales",
@@ -58,7 +76,20 @@ vat_descriptions = {
     "totalAcquisitionsExVAT": "Total acquisitions ex. VAT",
 }
 
+# Parse a YYYY-MM-DD string to a date.  All model date parsing goes through
+# here.  date.fromisoformat parses straight to a date, without building an
+# intermediate datetime.
+_parse_date = date.fromisoformat
+
+# (name, description, getter) for each of the 9 VAT boxes, in box order.
+# Built once so that print/submit loops don't repeat the lookups.
+_VAT_FIELD_TABLE = [
+    (n, vat_descriptions[n], operator.attrgetter(n))
+    for n in vat_fields
+]
+
 class Obligation:
+    __slots__ = ("periodKey", "status", "start", "end", "received", "due")
     def __init__(self, pKey, status, start, end, received=None, due=None):
         self.periodKey = pKey
         self.status = status
@@ -70,16 +101,12 @@ class Obligation:
     def from_dict(d):
         status  =  d["status"]
         periodKey  =  d["periodKey"]
-        start  =  datetime.fromisoformat(d["start"]).date()
-        end  =  datetime.fromisoformat(d["end"]).date()
-        if "due" in d:
-            due  =  datetime.fromisoformat(d["due"]).date()
-        else:
-            due = None
-        if "received" in d:
-            received  =  datetime.fromisoformat(d["received"]).date()
-        else:
-            received = None
+        start  =  _parse_date(d["start"])
+        end  =  _parse_date(d["end"])
+        due  =  d.get("due")
+        if due is not None: due = _parse_date(due)
+        received  =  d.get("received")
+        if received is not None: received = _parse_date(received)
         return Obligation(periodKey, status, start, end, received, due)
     def to_dict(self):
         obj = {
@@ -88,17 +115,19 @@ class Obligation:
             "start": self.start.isoformat(),
             "end": self.end.isoformat()
         }
-        if self.received != None:
+        if self.received is not None:
             obj["received"] = self.received.isoformat()
-        if self.due != None:
+        if self.due is not None:
             obj["due"] = self.due.isoformat()
         return obj
+    # True if the obligation period ends within start..end
     def in_range(self, start, end):
 #        if self.status == "O":
-#            return self.due >= start and self.due <= end
-        return self.end >= start and self.end <= end
+#            return start <= self.due <= end
+        return start <= self.end <= end
 
 class Liability:
+    __slots__ = ("start", "end", "typ", "original", "outstanding", "due")
     def __init__(self, start, end, typ, original, outstanding=None, due=None):
         self.start = start
         self.end = end
@@ -108,18 +137,13 @@ class Liability:
         self.due = due
     @staticmethod
     def from_dict(d):
-        start  =  datetime.fromisoformat(d["taxPeriod"]["from"]).date()
-        end  =  datetime.fromisoformat(d["taxPeriod"]["to"]).date()
+        start  =  _parse_date(d["taxPeriod"]["from"])
+        end  =  _parse_date(d["taxPeriod"]["to"])
         typ  =  d["type"]
         orig  =  d["originalAmount"]
-        if "outstandingAmount" in  d:
-            outs = d["outstandingAmount"]
-        else:
-            outs = None
-        if "due" in d:
-            due  =  datetime.fromisoformat(d["due"]).date()
-        else:
-            due = None
+        outs = d.get("outstandingAmount")
+        due  =  d.get("due")
+        if due is not None: due = _parse_date(due)
         return Liability(start, end, typ, orig, outs, due)
     def to_dict(self):
         obj = {
@@ -128,43 +152,43 @@ class Liability:
             "outstandingAmount": self.outstanding,
         }
 
-        if self.start and self.end:
+        if self.start is not None and self.end is not None:
             obj["taxPeriod"] = {
                 "from": self.start.isoformat(),
                 "to": self.end.isoformat()
             }
-        if self.due:
+        if self.due is not None:
             obj["due"] = self.due.isoformat()
         return obj
+    # True if the liability period overlaps start..end
     def in_range(self, start, end):
-        if self.start >= start and self.start <= end:
-            return True
-        if self.end >= start and self.end <= end:
-            return True
-        if self.start <= start and self.end >= end:
-            return True
-        return False
+        return self.start <= end and self.end >= start
 
 class Payment:
+    __slots__ = ("amount", "received")
     def __init__(self, amount, received):
         self.amount = amount
         self.received = received
     @staticmethod
     def from_dict(d):
         amount  =  d["amount"]
-        received  =  datetime.fromisoformat(d["received"]).date()
+        received  =  _parse_date(d["received"])
         return Payment(amount, received)
     def to_dict(self):
         return {
             "amount": self.amount,
             "received": self.received.isoformat()
         }
+    # True if the payment was received within start..end
     def in_range(self, start, end):
-        if self.received >= start and self.received <= end:
-            return True
-        return False
+        return start <= self.received <= end
+
+# Return rendering formats, (period key line, box line)
+_indented_formats = ("%-30s: %s\n", "%-30s: %15.2f\n")
+_plain_formats = ("%s: %s\n", "%s: %.2f\n")
 
 class Return:
+    __slots__ = ("periodKey",) + vat_fields + ("finalised",)
     def __init__(self):
         self.periodKey = None
         self.vatDueSales = None
@@ -190,8 +214,7 @@ class Return:
         r.totalValuePurchasesExVAT = d["totalValuePurchasesExVAT"]
         r.totalValueGoodsSuppliedExVAT = d["totalValueGoodsSuppliedExVAT"]
         r.totalAcquisitionsExVAT = d["totalAcquisitionsExVAT"]
-        if "finalised" in d:
-            r.finalised = d["finalised"]
+        r.finalised = d.get("finalised")
         return r
     def to_dict(self):
         d = {
@@ -209,57 +232,54 @@ class Return:
         if self.finalised:
             d["finalised"] = self.finalised
         return d
-    def to_string(self, show_key=False, indent=True):
+    # Renders the period key (if show_key) and the nine boxes using formats,
+    # a (key format, box format) pair.
+    def _render(self, show_key, formats):
+        key_fmt, fmt = formats
         s = ""
         if show_key:
-            if indent:
-                s += "%-30s: %s\n" % (
-                    "Period Key", self.periodKey
-                )
-            else:
-                s += "Period Key: %s\n" % self.periodKey
-        for v in [ "vatDueSales", "vatDueAcquisitions",
-                   "totalVatDue", "vatReclaimedCurrPeriod", "netVatDue",
-                   "totalValueSalesExVAT", "totalValuePurchasesExVAT",
-                   "totalValueGoodsSuppliedExVAT",
-                   "totalAcquisitionsExVAT" ]:
-            if indent:
-                s += "%-30s: %15.2f\n" % (
-                    vat_descriptions[v],
-                    getattr(self, v) if getattr(self, v) != None else 0
-                )
-            else:
-                s += "%s: %.2f\n" % (
-                    vat_descriptions[v],
-                    getattr(self, v) if getattr(self, v) != None else 0
-                )
+            s += key_fmt % ("Period Key", self.periodKey)
+        for name, desc, getter in _VAT_FIELD_TABLE:
+            val = getter(self)
+            if val is None: val = 0
+            s += fmt % (desc, val)
         return s
+    def to_string(self, show_key=False, indent=True):
+        if indent:
+            return self._render(show_key, _indented_formats)
+        return self._render(show_key, _plain_formats)
+    # Returns (indented, plain) renderings, for callers which need both.
+    def to_strings(self, show_key=False):
+        return (
+            self._render(show_key, _indented_formats),
+            self._render(show_key, _plain_formats)
+        )
 
 class VATUser:
+    __slots__ = ("_obligations", "returns", "liabilities", "payments",
+                 "open_index")
     def __init__(self):
         self.obligations = []
         self.returns = []
         self.liabilities = []
         self.payments = []
+    # open_index maps periodKey -> open obligation.  It is built on the
+    # first add_return, and dropped whenever obligations is assigned.  The
+    # obligations list should be replaced, not changed in place.
+    @property
+    def obligations(self):
+        return self._obligations
+    @obligations.setter
+    def obligations(self, obligations):
+        self._obligations = obligations
+        self.open_index = None
     @staticmethod
     def from_dict(d):
         v = VATUser()
-        v.obligations = [
-            Obligation.from_dict(v)
-            for v in d["obligations"]
-        ]
-        v.returns = [
-            Return.from_dict(v)
-            for v in d["returns"]
-        ]
-        v.payments = [
-            Payment.from_dict(v)
-            for v in d["payments"]
-        ]
-        v.liabilities = [
-            Liability.from_dict(v)
-            for v in d["liabilities"]
-        ]
+        v.obligations = list(map(Obligation.from_dict, d["obligations"]))
+        v.returns = list(map(Return.from_dict, d["returns"]))
+        v.payments = list(map(Payment.from_dict, d["payments"]))
+        v.liabilities = list(map(Liability.from_dict, d["liabilities"]))
         return v
     def to_dict(self):
         return {
@@ -268,18 +288,39 @@ class VATUser:
             "payments": [ v.to_dict() for v in self.payments ],
             "liabilities": [v.to_dict() for v in self.liabilities ]
         }
-    def add_return(self, rtn):
-        
-        key = rtn.periodKey
+    # Copy for use as another user's data.  add_return modifies obligations
+    # in place, and appends to returns/liabilities, so those are copied.
+    # Returns, liabilities and payments are never modified and are shared.
+    def clone(self):
+        v = VATUser()
+        v.obligations = [
+            Obligation(o.periodKey, o.status, o.start, o.end, o.received,
+                       o.due)
+            for o in self.obligations
+        ]
+        v.returns = list(self.returns)
+        v.liabilities = list(self.liabilities)
+        v.payments = list(self.payments)
+        return v
+    # Record a submitted return against its open obligation.  today is
+    # the received date, the current UTC date if not given, so callers
+    # adding several returns can look it up once.
+    def add_return(self, rtn, today=None):
+
+        if self.open_index == None:
+            self.open_index = {
+                o.periodKey: o for o in self.obligations if o.status == 'O'
+            }
 
-        obl = None
-        for v in self.obligations:
-            if v.periodKey == key and v.status == 'O': obl = v
+        obl = self.open_index.pop(rtn.periodKey, None)
 
         if obl == None:
             raise RuntimeError("periodKey does not match an open obligation")
 
-        obl.received = datetime.utcnow().date()
+        if today == None:
+            today = datetime.now(timezone.utc).date()
+
+        obl.received = today
         obl.status = 'F'
 
         due =  obl.end + timedelta(days=30)
@@ -291,23 +332,63 @@ class VATUser:
         
         self.returns.append(rtn)
 
+# json object_hook which builds each VRN's VATUser as soon as its object is
+# decoded.  Only user objects are recognised, the records inside are built
+# by position through VATUser.from_dict, so malformed input fails the same
+# way as it does through VATData.from_dict.
+def _model_hook(d):
+    if "obligations" in d:
+        return VATUser.from_dict(d)
+    return d
+
+# json.loads builds a new decoder on every call when given an object_hook,
+# so keep one around.
+_model_decoder = json.JSONDecoder(object_hook=_model_hook)
+
 class VATData:
+    __slots__ = ("data",)
     def __init__(self):
         self.data = {}
     @staticmethod
     def from_dict(d):
         v = VATData()
-        for vrn in d:
-            v.data[vrn] = VATUser.from_dict(d[vrn])
+        data = v.data
+        for vrn, user in d.items():
+            data[vrn] = VATUser.from_dict(user)
         return v
     def to_dict(self):
         return {
-            k: self.data[k].to_dict()
-            for k in self.data
+            vrn: user.to_dict()
+            for vrn, user in self.data.items()
         }
+    # With orjson, decode then convert.  Otherwise, users are converted as
+    # the json module decodes them.  An entry which wasn't recognised as a
+    # user goes through VATUser.from_dict, which reports what is missing.
     @staticmethod
     def from_json(s):
-        data = json.loads(s)
-        return VATData.from_dict(data)
+        if orjson != None:
+            return VATData.from_dict(orjson.loads(s))
+        v = VATData()
+        data = v.data
+        for vrn, user in _model_decoder.decode(s).items():
+            if type(user) != VATUser:
+                user = VATUser.from_dict(user)
+            data[vrn] = user
+        return v
+    def to_json(self):
+        return _json_dumps(self.to_dict())
+    # Load from a file.  If ijson is available, the file is parsed one VRN
+    # at a time so the raw dict tree for the whole file is never held in
+    # memory alongside the parsed objects.
+    @staticmethod
+    def from_file(path):
+        if ijson == None:
+            with open(path) as f:
+                return VATData.from_dict(json.load(f))
+        v = VATData()
+        with open(path, "rb") as f:
+            for vrn, user in ijson.kvitems(f, "", use_float=True):
+                v.data[vrn] = VATUser.from_dict(user)
+        return v
 #    def add_return(self, vrn, rtn):
 #        self.data[vrn].add_return(rtn)
@@ -1,6 +1,8 @@
 
 import sys
+import re
 import json
+import textwrap
 
 from tabulate import tabulate
 from datetime import datetime, timedelta
@@ -9,6 +11,45 @@ from . import accounts
 from . import model
 from . import vat
 
+# Display width of a string, wcwidth counts wide characters (e.g. CJK) as
+# two columns, as tabulate does when it is installed.
+try:
+    from wcwidth import wcswidth as _width
+except ImportError:
+    _width = len
+
+# Control characters (newlines, tabs etc.) in descriptions are shown as
+# spaces, so that every table row is one line of known width.
+_control_chars = re.compile(r"[\x00-\x1f\x7f-\x9f]")
+
+# Formats splits as a date / amount / description table.  Same layout as
+# tabulate's "pretty" format with left/right/left alignment, but column
+# widths are known after one pass so every row uses one format string.
+# Descriptions are padded by display width.
+def _splits_table(splits):
+
+    rows = []
+    for w in splits:
+        desc = _control_chars.sub(" ", w["description"][0:60]).strip()
+        rows.append((str(w["date"]), "%.2f" % w["amount"], desc, _width(desc)))
+
+    dw = max(len(r[0]) for r in rows)
+    aw = max(len(r[1]) for r in rows)
+    sw = max(r[3] for r in rows)
+
+    rule = "+%s+%s+%s+" % ("-" * (dw + 2), "-" * (aw + 2), "-" * (sw + 2))
+    fmt = "| %%-%ds | %%%ds | %%s%%s |" % (dw, aw)
+
+    lines = [rule]
+    lines.extend(fmt % (r[0], r[1], r[2], " " * (sw - r[3])) for r in rows)
+    lines.append(rule)
+
+    return "\n".join(lines)
+
+# Date as YYYY-MM-DD, or empty string if not set
+def _iso(d):
+    return d.isoformat() if d else ""
+
 # Perform authentication operation
 async def authenticate(h, auth):
 
@@ -32,9 +73,9 @@ async def show_open_obligations(h, config, print_json):
     if print_json:
         tbl = [
             { 
-               "start": v.start.strftime("%Y-%m-%d") if v.start else "", 
-               "end": v.end.strftime("%Y-%m-%d") if v.end else "", 
-               "due": v.due.strftime("%Y-%m-%d") if v.due else "", 
+               "start": _iso(v.start),
+               "end": _iso(v.end),
+               "due": _iso(v.due),
                "status": v.status if v.status else "" 
             }
             for v in obs
@@ -62,10 +103,10 @@ async def show_obligations(start, end, h, config, print_json):
     if print_json:
         tbl = [
             { 
-               "start": v.start.strftime("%Y-%m-%d") if v.start else "", 
-               "end": v.end.strftime("%Y-%m-%d") if v.end else "", 
-               "due": v.due.strftime("%Y-%m-%d") if v.due else "", 
-               "received": v.received.strftime("%Y-%m-%d") if v.received else "", 
+               "start": _iso(v.start),
+               "end": _iso(v.end),
+               "due": _iso(v.due),
+               "received": _iso(v.received),
                "status": v.status if v.status else "" 
             }
             for v in obs
@@ -84,9 +125,11 @@ async def show_obligations(start, end, h, config, print_json):
 # Submit a VAT return
 async def submit_vat_return(due, h, config):
 
+    vrn = config.get("identity.vrn")
+
     # We need start/end information, but only have a due date.
     # Load the obligations to get the mapping
-    obs = await h.get_open_obligations(config.get("identity.vrn"))
+    obs = await h.get_open_obligations(vrn)
 
     # Iterate over obligations to find the period
     obl = None
@@ -113,9 +156,8 @@ async def submit_vat_return(due, h, config):
     rtn.finalised = True
 
     # Add VAT values
-    for k in range(0, 9):
-        valueName = model.vat_fields[k]
-        setattr(rtn, valueName, vals[valueName]["total"])
+    for name in model.vat_fields:
+        setattr(rtn, name, vals[name]["total"])
 
     # Dump output.  Too late to fix anything anyway.
     # FIXME: Are you sure? etc.
@@ -135,7 +177,7 @@ declaration can result in prosecution.
         print("Answer not recognised.")
 
     # Call the API
-    resp = await h.submit_vat_return(config.get("identity.vrn"), rtn)
+    resp = await h.submit_vat_return(vrn, rtn)
 
     # Dump out the response
     print()
@@ -181,12 +223,12 @@ async def post_vat_bill(start, end, due, h, config):
     rtn.finalised = True
 
     # Add VAT values
-    for k in range(0, 9):
-        valueName = model.vat_fields[k]
-        setattr(rtn, valueName, vals[valueName]["total"])
+    for name in model.vat_fields:
+        setattr(rtn, name, vals[name]["total"])
 
     # Dump output.
-    sys.stdout.write(rtn.to_string())
+    report, notes = rtn.to_strings()
+    sys.stdout.write(report)
 
     # FIXME: How to work out due date?  Online says 1 cal month plus 7 days
     # from end of accounting period
@@ -196,7 +238,7 @@ async def post_vat_bill(start, end, due, h, config):
         end,
         end + timedelta(days=28) + timedelta(days=7),
         rtn,
-        rtn.to_string(indent=False),
+        notes,
         "VAT payment for due date " + str(due)
     )
 
@@ -205,6 +247,9 @@ async def post_vat_bill(start, end, due, h, config):
 # Show GnuCash information relating to open VAT obligations
 async def show_account_data(h, config, due, detail=False):
 
+    acct_kind = config.get("accounts.kind")
+    acct_file = config.get("accounts.file")
+
     # Get open obligations
     obs = await h.get_open_obligations(config.get("identity.vrn"))
 
@@ -220,26 +265,23 @@ async def show_account_data(h, config, due, detail=False):
 
     print("Found Obligation that is due on '%s'" % due)
     # Get accounts
-    cls = accounts.get_class(config.get("accounts.kind"))
-    accts = cls(config.get("accounts.file"))
+    cls = accounts.get_class(acct_kind)
+    accts = cls(acct_file)
 
     # Write out obligation header
     print()
     print("Search for account data in '%s' from '%-10s' to '%-10s'" % (
-        config.get("accounts.file"), obl.start, obl.end
+        acct_file, obl.start, obl.end
     ))
     print()
 
     # Get VAT values for this period from accounts
     vals = vat.get_vat(accts, config, obl.start, obl.end)
 
-    # Loop over 9 boxes (0 .. 8 in this loop)
-    for k in range(0, 9):
+    # Loop over 9 boxes
+    for valueName in model.vat_fields:
 
-        # Get the name of the VAT value
-        valueName = model.vat_fields[k]
-
-        valueDesc = model.vat_descriptions.get(valueName, valueName)
+        valueDesc = model.vat_descriptions[valueName]
 
         # Output the value
         print("    %s: %.2f" % (valueDesc, vals[valueName]["total"]))
@@ -252,31 +294,22 @@ async def show_account_data(h, config, due, detail=False):
         # Dump out all contributing transactions
         if len(vals[valueName]["splits"]) > 0:
 
-            # Construct a transaction table
-            tbl = []
-
-            # Add transactions to table
-            for w in vals[valueName]["splits"]:
-                tbl.append([
-                    w["date"], "%.2f" % w["amount"], w["description"][0:60]
-                ])
-
-            # Create table
-            tbl = tabulate(tbl, tablefmt="pretty",
-                           colalign=("left", "right","left"))
+            # Create transaction table
+            tbl = _splits_table(vals[valueName]["splits"])
 
             # Indent table by 8 characters
-            tbl = "        " + tbl.replace("\n", "\n        ")
-            print(tbl)
+            print(textwrap.indent(tbl, "        "))
 
             print()
 
 # Dump out a VAT return
 async def show_vat_return(start, end, due, h, config):
 
+    vrn = config.get("identity.vrn")
+
     # We need start/end information, but only have a period key first.
     # Load the obligations to get the mapping
-    obs = await h.get_obligations(config.get("identity.vrn"), start, end)
+    obs = await h.get_obligations(vrn, start, end)
 
     # Iterate over obligations to find the period
     obl = None
@@ -288,7 +321,7 @@ async def show_vat_return(start, end, due, h, config):
         raise RuntimeError("Due date '%s' does not match any obligation" % due)
 
     # Fetch VAT return data
-    rtn = await h.get_vat_return(config.get("identity.vrn"), obl.periodKey)
+    rtn = await h.get_vat_return(vrn, obl.periodKey)
     sys.stdout.write(rtn.to_string())
 
 # Show liabilities
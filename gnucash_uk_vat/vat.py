@@ -1,11 +1,48 @@
+import math
+
 from . import model
 
+# Decimal places each box is rounded to.  Boxes 1 to 5 accept pence,
+# numbers do need to be 2 decimal places, though.  Boxes 6 to 9 are pounds
+# only, round off the pence.
+box_places = [2, 2, 2, 2, 2, 0, 0, 0, 0]
+
+# Fetch splits for one account, and the account total with the sign
+# corrected for debit accounts.  Splits from the accounts layer are not
+# modified, debit account splits are returned as sign-corrected copies.
+def get_account_splits(accounts, locator, start, end):
+
+    acct = accounts.get_account(None, locator)
+    splits = accounts.get_splits(acct, start, end)
+
+    total = math.fsum(spl["amount"] for spl in splits)
+
+    if accounts.is_debit(acct):
+        total = -total
+        splits = [
+            dict(spl, amount=-spl["amount"])
+            for spl in splits
+        ]
+
+    return splits, total
+
 # Return VAT return for the defined period.  Makes use of the
 # configuration object to describe which accounts to analyse.
 def get_vat(accounts, config, start, end):
 
     vat = {}
 
+    # Boxes usually share accounts, e.g. the output VAT account feeds boxes
+    # 1, 3 and 5.  Each account's splits are fetched from the accounts
+    # layer once, keyed by locator.
+    fetched = {}
+    def fetch(locator):
+        if locator not in fetched:
+            fetched[locator] = get_account_splits(
+                accounts, locator, start, end
+            )
+        return fetched[locator]
+
     # Boxes 1 to 9, are referred to as 0 to 8 in this loop.
     for v in range(0, 9):
 
@@ -14,41 +51,34 @@ def get_vat(accounts, config, start, end):
         locator = config.get("accounts").get(valueName)
 
         if isinstance(locator, str):
-            acct = accounts.get_account(None, locator)
-            all_splits = accounts.get_splits(acct, start, end)
-            if accounts.is_debit(acct):
-                for spl in all_splits:
-                    spl["amount"] *= -1
+            splits, total = fetch(locator)
+            all_splits = list(splits)
         elif isinstance(locator, list):
             all_splits = []
+            totals = []
             for elt in locator:
-                acct = accounts.get_account(None, elt)
-                splits = accounts.get_splits(acct, start, end)
-                if accounts.is_debit(acct):
-                    for spl in splits:
-                        spl["amount"] *= -1
+                splits, total = fetch(elt)
                 all_splits.extend(splits)
+                totals.append(total)
+            total = math.fsum(totals)
         else:
             raise RuntimeError("Accounts should be strings or lists")
 
-        vat[valueName] = {
-            "splits": all_splits,
-            "total": sum([v["amount"] for v in all_splits])
-        }
-
-        # These boxes accept pence.  Numbers do need to be 2
-        # decimal places, though.
-        if v in [0, 1, 2, 3, 4]:
-            vat[valueName]["total"] = round(vat[valueName]["total"], 2)
-
-        # Some boxes are pounds only, round off the pence.
-        if v in [5, 6, 7, 8]:
-            vat[valueName]["total"] = round(vat[valueName]["total"])
+        places = box_places[v]
+        if places:
+            total = round(total, places)
+        else:
+            total = round(total)
 
         # VAT value is always positive, boxes 3 and 4 are studied to
         # determine refund vs payment
         if v == 4:
-            vat[valueName]["total"] = abs(vat[valueName]["total"])
+            total = abs(total)
+
+        vat[valueName] = {
+            "splits": all_splits,
+            "total": total
+        }
 
     return vat
 
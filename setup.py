@@ -1,18 +1,13 @@
 
 import setuptools
-import importlib
+import re
 
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
-# Load a version number module?!
-spec = importlib.util.spec_from_file_location(
-    'version', 'gnucash_uk_vat/version.py'
-)
-version_module = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(version_module)
-
-version = version_module.version
+# Read the version string from the version module without executing it
+with open("gnucash_uk_vat/version.py", "r") as fh:
+    version = re.search(r'version\s*=\s*"([^"]+)"', fh.read()).group(1)
 
 setuptools.setup(
     name="gnucash-uk-vat",
@@ -0,0 +1,208 @@
+
+import datetime
+
+example_start = datetime.date.fromisoformat("2021-01-01")
+example_end = datetime.date.fromisoformat("2021-03-31")
+
+# Accounts are name -> (debit flag, list of (date, amount))
+example_accounts = {
+    "Income:Sales": (True, [
+        ("2021-01-05", -1000.0), ("2021-02-11", -250.5),
+        ("2020-12-31", -999.0),
+    ]),
+    "Liabilities:VAT:Output": (True, [
+        ("2021-01-05", -200.0), ("2021-02-11", -50.1),
+    ]),
+    "Assets:VAT:Input": (False, [
+        ("2021-03-01", 40.25), ("2021-03-31", 10.0),
+    ]),
+    "Expenses:Purchases": (False, [
+        ("2021-03-01", 201.25), ("2021-04-01", 50.0),
+    ]),
+    "Expenses:Equipment": (False, [
+        ("2021-03-31", 1000.4),
+    ]),
+    "Empty": (False, []),
+}
+
+example_config = {
+    "accounts": {
+        "vatDueSales": "Liabilities:VAT:Output",
+        "vatDueAcquisitions": "Empty",
+        "totalVatDue": "Liabilities:VAT:Output",
+        "vatReclaimedCurrPeriod": "Assets:VAT:Input",
+        "netVatDue": ["Liabilities:VAT:Output", "Assets:VAT:Input"],
+        "totalValueSalesExVAT": "Income:Sales",
+        "totalValuePurchasesExVAT": [
+            "Expenses:Purchases", "Expenses:Equipment"
+        ],
+        "totalValueGoodsSuppliedExVAT": "Empty",
+        "totalAcquisitionsExVAT": "Empty",
+    }
+}
+
+class MockConfig:
+    def __init__(self, config):
+        self.config = config
+    def get(self, key):
+        return self.config[key]
+
+# Hands out the same split dicts on every call, like a caching backend
+class MockAccounts:
+    def __init__(self):
+        self.cache = {}
+    def get_account(self, par, locator):
+        return locator
+    def get_splits(self, acct, start, end):
+        key = (acct, start, end)
+        if key not in self.cache:
+            self.cache[key] = self.fetch_splits(acct, start, end)
+        return self.cache[key]
+    def fetch_splits(self, acct, start, end):
+        return [
+            {
+                "date": datetime.date.fromisoformat(dt),
+                "amount": amount,
+                "description": acct,
+            }
+            for dt, amount in example_accounts[acct][1]
+            if datetime.date.fromisoformat(dt) >= start
+            and datetime.date.fromisoformat(dt) <= end
+        ]
+    def is_debit(self, acct):
+        return example_accounts[acct][0]
+
+def test_get_vat():
+
+    from gnucash_uk_vat.vat import get_vat
+
+    vals = get_vat(
+        MockAccounts(), MockConfig(example_config), example_start, example_end
+    )
+
+    assert(vals["vatDueSales"]["total"] == 250.1)
+    assert(vals["vatDueAcquisitions"]["total"] == 0)
+    assert(vals["totalVatDue"]["total"] == 250.1)
+    assert(vals["vatReclaimedCurrPeriod"]["total"] == 50.25)
+
+    # Box 5 is always positive
+    assert(vals["netVatDue"]["total"] == 300.35)
+
+    # Boxes 6 to 9 are whole pounds
+    assert(vals["totalValueSalesExVAT"]["total"] == 1250)
+    assert(type(vals["totalValueSalesExVAT"]["total"]) == int)
+    assert(vals["totalValuePurchasesExVAT"]["total"] == 1202)
+
+    # Splits are reported with debit account signs corrected
+    assert(
+        [v["amount"] for v in vals["totalValueSalesExVAT"]["splits"]] ==
+        [1000.0, 250.5]
+    )
+    assert(
+        [v["amount"] for v in vals["netVatDue"]["splits"]] ==
+        [200.0, 50.1, 40.25, 10.0]
+    )
+
+def test_get_vat_repeatable():
+
+    from gnucash_uk_vat.vat import get_vat
+
+    accts = MockAccounts()
+    config = MockConfig(example_config)
+
+    first = get_vat(accts, config, example_start, example_end)
+    second = get_vat(accts, config, example_start, example_end)
+
+    assert(first == second)
+
+    # Accounts layer splits are left alone
+    assert(
+        [
+            v["amount"]
+            for v in accts.get_splits("Income:Sales", example_start,
+                                      example_end)
+        ] == [-1000.0, -250.5]
+    )
+
+def test_get_vat_fetches_accounts_once():
+
+    from gnucash_uk_vat.vat import get_vat
+
+    class CountingAccounts(MockAccounts):
+        def __init__(self):
+            MockAccounts.__init__(self)
+            self.fetched = []
+        def get_splits(self, acct, start, end):
+            self.fetched.append(acct)
+            return self.fetch_splits(acct, start, end)
+
+    accts = CountingAccounts()
+    vals = get_vat(
+        accts, MockConfig(example_config), example_start, example_end
+    )
+
+    assert(sorted(accts.fetched) == sorted(set(accts.fetched)))
+    assert(len(accts.fetched) == 6)
+
+    # Boxes sharing an account do not share a splits list
+    assert(vals["vatDueSales"]["splits"] == vals["totalVatDue"]["splits"])
+    assert(
+        vals["vatDueSales"]["splits"] is not vals["totalVatDue"]["splits"]
+    )
+
+def test_get_vat_piecash():
+
+    import pytest
+    import os
+    import json
+
+    pytest.importorskip("piecash")
+
+    from gnucash_uk_vat.vat import get_vat
+    from gnucash_uk_vat.accounts_piecash import Accounts
+
+    # Walks each account's splits relationship, as get_splits used to
+    class SplitsAccounts(Accounts):
+        def get_splits(self, acct, start, end, endinclusive=True):
+            splits = []
+            for v in acct.children:
+                splits.extend(self.get_splits(v, start, end))
+            for spl in acct.splits:
+                tx = spl.transaction
+                if tx.post_date >= start and tx.post_date <= end:
+                    splits.append({
+                        "date": tx.post_date,
+                        "amount": float(spl.value),
+                        "description": tx.description
+                    })
+            return splits
+
+    test_dir = os.path.join(os.path.dirname(__file__), "..", "test")
+    book = os.path.join(test_dir, "hmrc-test.sqlite3.gnucash")
+    with open(os.path.join(test_dir, "config.example.json")) as f:
+        config = MockConfig(json.load(f))
+
+    accts = Accounts(book)
+    expected = SplitsAccounts(book)
+
+    d = datetime.date.fromisoformat
+
+    for start, end in [
+            (d("2017-01-01"), d("2017-03-31")),
+            (d("2017-04-01"), d("2017-06-30")),
+            (d("2017-01-17"), d("2017-01-17")),
+    ]:
+
+        vals = get_vat(accts, config, start, end)
+        exp = get_vat(expected, config, start, end)
+
+        for name in vals:
+            assert(vals[name]["total"] == exp[name]["total"])
+            assert(
+                sorted(v["amount"] for v in vals[name]["splits"]) ==
+                sorted(v["amount"] for v in exp[name]["splits"])
+            )
+
+    vals = get_vat(accts, config, d("2017-01-01"), d("2017-03-31"))
+    assert(vals["totalValueSalesExVAT"]["total"] == 40300)
+    assert(vals["vatDueSales"]["total"] == 6995)
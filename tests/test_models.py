@@ -1,5 +1,6 @@
 
 import datetime
+import pytest
 
 example_start = datetime.date.fromisoformat("2019-04-06")
 example_end = datetime.date.fromisoformat("2023-12-29")
@@ -84,3 +85,374 @@ def test_return_model():
     assert(rtn.totalAcquisitionsExVAT == example_box_9)
     assert(rtn.finalised == True)
 
+
+def test_return_to_string():
+
+    from gnucash_uk_vat.model import Return
+
+    rtn = Return()
+    rtn.periodKey = example_period_key
+    rtn.vatDueSales = example_box_1
+    rtn.totalAcquisitionsExVAT = example_box_9
+
+    s = rtn.to_string(show_key=True)
+    lines = s.split("\n")
+
+    assert(len(lines) == 11)
+    assert(lines[0] == "%-30s: %s" % ("Period Key", example_period_key))
+    assert(lines[1] == "%-30s: %15.2f" % ("VAT due on sales", example_box_1))
+    assert(lines[2] == "%-30s: %15.2f" % ("VAT due on acquisitions", 0))
+    assert(lines[9] == "%-30s: %15.2f" % (
+        "Total acquisitions ex. VAT", example_box_9
+    ))
+
+    s = rtn.to_string(indent=False)
+    lines = s.split("\n")
+
+    assert(len(lines) == 10)
+    assert(lines[0] == "VAT due on sales: 0.51")
+    assert(lines[1] == "VAT due on acquisitions: 0.00")
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_vat_data_from_file(tmp_path, monkeypatch, streaming):
+
+    import gnucash_uk_vat.model as m
+    from gnucash_uk_vat.model import VATData
+    import json
+
+    if streaming:
+        pytest.importorskip("ijson")
+    else:
+        monkeypatch.setattr(m, "ijson", None)
+
+    input = {
+        "123456789": {
+            "obligations": [
+                {
+                    "periodKey": example_period_key,
+                    "start": str(example_start),
+                    "end": str(example_end),
+                    "status": "O",
+                    "due": str(example_due),
+                }
+            ],
+            "returns": [],
+            "payments": [
+                { "amount": example_box_2, "received": str(example_received) }
+            ],
+            "liabilities": [],
+        }
+    }
+
+    path = tmp_path / "vat-data.json"
+    path.write_text(json.dumps(input))
+
+    data = VATData.from_file(str(path))
+
+    assert(data.to_dict() == input)
+    assert(data.data["123456789"].obligations[0].due == example_due)
+    assert(type(data.data["123456789"].payments[0].amount) == float)
+
+def test_vat_data_json():
+
+    from gnucash_uk_vat.model import VATData
+    import json
+
+    input = {
+        "123456789": {
+            "obligations": [
+                {
+                    "periodKey": example_period_key,
+                    "start": str(example_start),
+                    "end": str(example_end),
+                    "status": "F",
+                    "received": str(example_received),
+                }
+            ],
+            "returns": [],
+            "payments": [],
+            "liabilities": [],
+        }
+    }
+
+    data = VATData.from_json(json.dumps(input))
+    assert(data.data["123456789"].obligations[0].end == example_end)
+
+    s = data.to_json()
+    assert(type(s) == str)
+    assert(json.loads(s) == input)
+
+def test_vat_data_json_without_orjson(monkeypatch):
+
+    import gnucash_uk_vat.model as m
+    import json
+
+    monkeypatch.setattr(m, "orjson", None)
+
+    input = {
+        "123456789": {
+            "obligations": [
+                {
+                    "periodKey": example_period_key,
+                    "start": str(example_start),
+                    "end": str(example_end),
+                    "status": "O",
+                    "due": str(example_due),
+                }
+            ],
+            "returns": [
+                {
+                    "periodKey": example_period_key,
+                    "vatDueSales": example_box_1,
+                    "vatDueAcquisitions": example_box_2,
+                    "totalVatDue": example_box_3,
+                    "vatReclaimedCurrPeriod": example_box_4,
+                    "netVatDue": example_box_5,
+                    "totalValueSalesExVAT": example_box_6,
+                    "totalValuePurchasesExVAT": example_box_7,
+                    "totalValueGoodsSuppliedExVAT": example_box_8,
+                    "totalAcquisitionsExVAT": example_box_9,
+                    "finalised": True,
+                }
+            ],
+            "payments": [
+                { "amount": example_box_2, "received": str(example_received) }
+            ],
+            "liabilities": [
+                {
+                    "taxPeriod": {
+                        "from": str(example_start), "to": str(example_end)
+                    },
+                    "type": "Net VAT",
+                    "originalAmount": example_box_5,
+                    "outstandingAmount": example_box_5,
+                    "due": str(example_due),
+                }
+            ],
+        }
+    }
+
+    data = m.VATData.from_json(json.dumps(input))
+
+    user = data.data["123456789"]
+    assert(type(user) == m.VATUser)
+    assert(type(user.obligations[0]) == m.Obligation)
+    assert(type(user.returns[0]) == m.Return)
+    assert(type(user.payments[0]) == m.Payment)
+    assert(type(user.liabilities[0]) == m.Liability)
+    assert(data.to_dict() == input)
+
+def test_vat_data_json_malformed(monkeypatch):
+
+    import gnucash_uk_vat.model as m
+    import json
+    import pytest
+
+    liability = {
+        "taxPeriod": { "from": str(example_start), "to": str(example_end) },
+        "type": "Net VAT",
+        "outstandingAmount": example_box_5,
+    }
+    payment = { "received": str(example_received) }
+
+    user = { "obligations": [], "returns": [], "payments": [],
+             "liabilities": [] }
+
+    cases = [
+        ({ "123": dict(user, liabilities=[liability]) }, "originalAmount"),
+        ({ "123": dict(user, payments=[payment]) }, "amount"),
+        ({ "123": { "returns": [], "payments": [], "liabilities": [] } },
+         "obligations"),
+        ({ "123": { "obligations": [] } }, "returns"),
+    ]
+
+    for input, missing in cases:
+
+        s = json.dumps(input)
+
+        # Both decode paths reject the input the same way
+        with pytest.raises(KeyError, match=missing):
+            m.VATData.from_dict(json.loads(s))
+        if m.orjson != None:
+            with pytest.raises(KeyError, match=missing):
+                m.VATData.from_json(s)
+        with monkeypatch.context() as mp:
+            mp.setattr(m, "orjson", None)
+            with pytest.raises(KeyError, match=missing):
+                m.VATData.from_json(s)
+
+def test_return_to_strings():
+
+    from gnucash_uk_vat.model import Return
+
+    rtn = Return.from_dict({
+        "periodKey": example_period_key,
+        "vatDueSales": example_box_1,
+        "vatDueAcquisitions": example_box_2,
+        "totalVatDue": example_box_3,
+        "vatReclaimedCurrPeriod": example_box_4,
+        "netVatDue": example_box_5,
+        "totalValueSalesExVAT": example_box_6,
+        "totalValuePurchasesExVAT": example_box_7,
+        "totalValueGoodsSuppliedExVAT": example_box_8,
+        "totalAcquisitionsExVAT": example_box_9,
+    })
+
+    assert(
+        rtn.to_strings() ==
+        (rtn.to_string(), rtn.to_string(indent=False))
+    )
+    assert(
+        rtn.to_strings(show_key=True) ==
+        (
+            rtn.to_string(show_key=True),
+            rtn.to_string(show_key=True, indent=False)
+        )
+    )
+
+def test_liability_in_range():
+
+    from gnucash_uk_vat.model import Liability
+
+    d = datetime.date.fromisoformat
+
+    liab = Liability(d("2021-01-01"), d("2021-03-31"), "Net VAT", 100)
+
+    # Overlaps start, overlaps end, contained, containing
+    assert(liab.in_range(d("2020-12-01"), d("2021-01-01")))
+    assert(liab.in_range(d("2021-03-31"), d("2021-05-01")))
+    assert(liab.in_range(d("2021-02-01"), d("2021-02-28")))
+    assert(liab.in_range(d("2020-01-01"), d("2022-01-01")))
+
+    # Entirely before, entirely after
+    assert(not liab.in_range(d("2020-01-01"), d("2020-12-31")))
+    assert(not liab.in_range(d("2021-04-01"), d("2021-06-30")))
+
+def test_vat_user_clone():
+
+    from gnucash_uk_vat.model import VATUser, Obligation, Return
+
+    user = VATUser()
+    user.obligations = [
+        Obligation(example_period_key, "O", example_start, example_end,
+                   None, example_due)
+    ]
+
+    clone = user.clone()
+
+    rtn = Return()
+    rtn.periodKey = example_period_key
+    rtn.netVatDue = example_box_5
+    clone.add_return(rtn)
+
+    # Clone is updated...
+    assert(clone.obligations[0].status == "F")
+    assert(len(clone.returns) == 1)
+    assert(len(clone.liabilities) == 1)
+
+    # ...original is not
+    assert(user.obligations[0].status == "O")
+    assert(user.obligations[0].received == None)
+    assert(user.returns == [])
+    assert(user.liabilities == [])
+
+def test_obligation_payment_in_range():
+
+    from gnucash_uk_vat.model import Obligation, Payment
+    import datetime
+
+    d = datetime.date.fromisoformat
+
+    obl = Obligation("#001", "O", d("2021-01-01"), d("2021-03-31"))
+
+    # Selected by period end, inclusive at both ends of the range
+    assert(obl.in_range(d("2021-03-31"), d("2021-04-30")))
+    assert(obl.in_range(d("2021-03-01"), d("2021-03-31")))
+    assert(not obl.in_range(d("2021-01-01"), d("2021-03-30")))
+    assert(not obl.in_range(d("2021-04-01"), d("2021-06-30")))
+
+    pay = Payment(100, d("2021-05-07"))
+
+    assert(pay.in_range(d("2021-05-07"), d("2021-05-07")))
+    assert(pay.in_range(d("2021-01-01"), d("2021-12-31")))
+    assert(not pay.in_range(d("2021-05-08"), d("2021-12-31")))
+    assert(not pay.in_range(d("2021-01-01"), d("2021-05-06")))
+
+def test_vat_user_add_return():
+
+    from gnucash_uk_vat.model import VATUser, Obligation, Return
+    import pytest
+
+    user = VATUser()
+    user.obligations = [
+        Obligation("#001", "F", example_start, example_end),
+        Obligation("#002", "O", example_start, example_end, None, example_due),
+        Obligation("#003", "O", example_start, example_end, None, example_due),
+    ]
+
+    rtn = Return()
+    rtn.periodKey = "#002"
+    rtn.netVatDue = example_box_5
+    user.add_return(rtn)
+
+    assert(user.obligations[1].status == "F")
+    assert(user.obligations[1].received != None)
+    assert(user.obligations[2].status == "O")
+
+    rtn = Return()
+    rtn.periodKey = "#003"
+    user.add_return(rtn, example_received)
+    assert(user.obligations[2].received == example_received)
+
+    # Each obligation can only be fulfilled once, and only if it is open
+    for key in ["#001", "#002", "#999"]:
+        rtn = Return()
+        rtn.periodKey = key
+        with pytest.raises(RuntimeError):
+            user.add_return(rtn)
+
+    assert(len(user.returns) == 2)
+    assert(len(user.liabilities) == 2)
+
+def test_vat_user_add_return_reassigned():
+
+    from gnucash_uk_vat.model import VATUser, Obligation, Return
+    import pytest
+
+    user = VATUser()
+    user.obligations = [
+        Obligation("#001", "O", example_start, example_end),
+    ]
+
+    rtn = Return()
+    rtn.periodKey = "#001"
+    user.add_return(rtn)
+
+    # Replacing the obligations after a return has been added
+    replaced = Obligation("#002", "O", example_start, example_end)
+    user.obligations = [
+        Obligation("#002", "O", example_start, example_end),
+        Obligation("#003", "O", example_start, example_end),
+    ]
+
+    rtn = Return()
+    rtn.periodKey = "#003"
+    user.add_return(rtn)
+
+    assert(user.obligations[1].status == "F")
+    assert(user.obligations[0].status == "O")
+
+    # Same for a clone with obligations assigned directly
+    clone = user.clone()
+    clone.obligations = [replaced]
+
+    rtn = Return()
+    rtn.periodKey = "#002"
+    clone.add_return(rtn)
+    assert(replaced.status == "F")
+    assert(user.obligations[0].status == "O")
+
+    rtn = Return()
+    rtn.periodKey = "#003"
+    with pytest.raises(RuntimeError):
+        clone.add_return(rtn)
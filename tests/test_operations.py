@@ -0,0 +1,88 @@
+
+import datetime
+
+from tabulate import tabulate
+
+example_splits = [
+    {
+        "date": datetime.date.fromisoformat("2021-03-04"),
+        "amount": 1234.5,
+        "description": "Invoice 123 to Aardvark Limited",
+    },
+    {
+        "date": datetime.date.fromisoformat("2021-03-17"),
+        "amount": -0.25,
+        "description": "Refund",
+    },
+]
+
+def test_splits_table():
+
+    from gnucash_uk_vat.operations import _splits_table
+
+    expected = tabulate(
+        [
+            [w["date"], "%.2f" % w["amount"], w["description"][0:60]]
+            for w in example_splits
+        ],
+        tablefmt="pretty", colalign=("left", "right", "left")
+    )
+
+    assert(_splits_table(example_splits) == expected)
+
+def test_splits_table_multiline():
+
+    from gnucash_uk_vat.operations import _splits_table
+
+    splits = example_splits + [
+        {
+            "date": datetime.date.fromisoformat("2021-03-20"),
+            "amount": 10.0,
+            "description": "First line\nsecond line",
+        },
+        {
+            "date": datetime.date.fromisoformat("2021-03-21"),
+            "amount": 20.0,
+            "description": "Tab\tseparated",
+        },
+    ]
+
+    lines = _splits_table(splits).split("\n")
+
+    # One line per split, plus top and bottom rules, all the same width
+    assert(len(lines) == len(splits) + 2)
+    assert(len(set(len(v) for v in lines)) == 1)
+    assert("| First line second line " in lines[3])
+    assert("| Tab separated " in lines[4])
+
+def test_splits_table_wide():
+
+    import pytest
+
+    wcwidth = pytest.importorskip("wcwidth")
+
+    from gnucash_uk_vat.operations import _splits_table
+
+    splits = example_splits + [
+        {
+            "date": datetime.date.fromisoformat("2021-03-20"),
+            "amount": 10.0,
+            "description": "漢字テスト",
+        },
+    ]
+
+    table = _splits_table(splits)
+
+    # Wide characters take two columns, so rows line up on screen
+    lines = table.split("\n")
+    assert(len(set(wcwidth.wcswidth(v) for v in lines)) == 1)
+
+    expected = tabulate(
+        [
+            [w["date"], "%.2f" % w["amount"], w["description"]]
+            for w in splits
+        ],
+        tablefmt="pretty", colalign=("left", "right", "left")
+    )
+
+    assert(table == expected)
@@ -1,13 +1,14 @@
 
 import pytest
 
-from gnucash_uk_vat.hmrc import Vat
+from gnucash_uk_vat.hmrc import Vat, VatTest, VatLocalTest, AuthCollector, create
 from gnucash_uk_vat.model import Liability, Return
 import datetime
 from urllib.parse import urlencode, quote_plus
 import hashlib
 import json
 import aiohttp
+import asyncio
 
 example_client_id = "09198fncaw9890"
 example_mac_address = "01:23:45:67:89:ab"
@@ -126,16 +127,27 @@ expected_headers={
 example_api_base = "https://example.com.nonexistent"
 example_oauth_base = "ftp://asdlkjasd.nonexistent.asdklasdasda"
 
+class MockStream:
+    def __init__(self, data):
+        self.data = data
+
+    async def read(self, n=-1):
+        if n < 0: n = len(self.data)
+        ret, self.data = self.data[:n], self.data[n:]
+        return ret
+
 class MockResponse:
-    def __init__(self, text, status):
+    def __init__(self, text, status, headers={}):
         self.obj = text
         self.status = status
+        self.headers = headers
+        self.content = MockStream(json.dumps(text).encode("utf-8"))
 
     async def text(self):
         return json.dumps(self.obj)
 
-    async def json(self):
-        return self.obj
+    async def json(self, loads=json.loads):
+        return loads(json.dumps(self.obj))
 
     async def __aexit__(self, exc_type, exc, tb):
         pass
@@ -196,6 +208,21 @@ def test_fraud_headers():
     # What's the point of the above?  This tests just as well
     assert(headers == expected_headers)
 
+def test_fraud_headers_cached():
+
+    vat = create_vat_client()
+
+    headers = vat.build_fraud_headers()
+    headers['Accept'] = 'application/vnd.hmrc.1.0+json'
+
+    # Caller changes don't leak into the next set of headers, and a new
+    # access token is picked up
+    vat.auth = dict(example_auth, access_token="new-token")
+    assert(
+        vat.build_fraud_headers() ==
+        expected_headers | { 'Authorization': 'Bearer new-token' }
+    )
+
 @pytest.mark.asyncio    
 async def test_get_vat_liabilities(mocker):
 
@@ -209,6 +236,8 @@ async def test_get_vat_liabilities(mocker):
         example_vrn, example_start, example_end
     )
 
+    await vat.close()
+
     aiohttp.ClientSession.get.assert_called_once_with(
         f"{example_api_base}/organisations/vat/918273645/liabilities?from=2019-04-06&to=2023-12-29",
         headers=expected_headers | {
@@ -257,6 +286,8 @@ async def test_get_vat_return(mocker):
 
     rtn = await vat.get_vat_return(example_vrn, example_period_key)
 
+    await vat.close()
+
     aiohttp.ClientSession.get.assert_called_once_with(
         f"{example_api_base}/organisations/vat/918273645/returns/K1234",
         headers=expected_headers | {
@@ -290,6 +321,8 @@ async def test_submit_vat_return(mocker):
         Return.from_dict(example_return)
     )
 
+    await vat.close()
+
     aiohttp.ClientSession.post.assert_called_once_with(
         f"{example_api_base}/organisations/vat/918273645/returns",
         headers=expected_headers | {
@@ -300,3 +333,405 @@ async def test_submit_vat_return(mocker):
 
     assert(resp == example_submission_response)
 
+
+@pytest.mark.asyncio
+async def test_session_reuse():
+
+    vat = create_vat_client()
+
+    session = await vat.get_session()
+    assert(await vat.get_session() is session)
+
+    await vat.close()
+    assert(session.closed)
+
+    # A new session is created after close
+    assert(await vat.get_session() is not session)
+
+    await vat.close()
+
+@pytest.mark.asyncio
+async def test_retry(mocker):
+
+    vat = create_vat_client()
+
+    mocker.patch('aiohttp.ClientSession.get', side_effect=[
+        MockResponse({"message": "busy"}, 503, {"Retry-After": "2"}),
+        MockResponse({"message": "slow down"}, 429),
+        MockResponse(example_return, 200),
+    ])
+    sleep = mocker.patch('asyncio.sleep')
+
+    rtn = await vat.get_vat_return(example_vrn, example_period_key)
+
+    await vat.close()
+
+    assert(aiohttp.ClientSession.get.call_count == 3)
+    assert(rtn.periodKey == example_return["periodKey"])
+
+    # Retry-After wins, then backoff for the second attempt
+    assert(sleep.call_args_list[0].args[0] == pytest.approx(2.0, abs=0.1))
+    assert(1.9 <= sleep.call_args_list[1].args[0] <= 2.5)
+
+@pytest.mark.asyncio
+async def test_retry_exhausted(mocker):
+
+    vat = create_vat_client()
+
+    mocker.patch(
+        'aiohttp.ClientSession.get',
+        side_effect=lambda *a, **k: MockResponse({"message": "busy"}, 503)
+    )
+    mocker.patch('asyncio.sleep')
+
+    with pytest.raises(RuntimeError, match="busy"):
+        await vat.get_vat_return(example_vrn, example_period_key)
+
+    await vat.close()
+
+    assert(aiohttp.ClientSession.get.call_count == 6)
+
+@pytest.mark.asyncio
+async def test_submit_not_retried(mocker):
+
+    vat = create_vat_client()
+
+    # A gateway error might come after the return was filed, so it is not
+    # sent again
+    mocker.patch('aiohttp.ClientSession.post', side_effect=[
+        MockResponse({"message": "bad gateway"}, 502),
+        MockResponse(example_submission_response, 201),
+    ])
+    mocker.patch('asyncio.sleep')
+
+    rtn = Return.from_dict(example_return)
+
+    with pytest.raises(RuntimeError, match="bad gateway"):
+        await vat.submit_vat_return(example_vrn, rtn)
+
+    assert(aiohttp.ClientSession.post.call_count == 1)
+
+    # Rate limiting means it wasn't processed, so that is retried
+    mocker.patch('aiohttp.ClientSession.post', side_effect=[
+        MockResponse({"message": "slow down"}, 429),
+        MockResponse(example_submission_response, 201),
+    ])
+
+    resp = await vat.submit_vat_return(example_vrn, rtn)
+
+    await vat.close()
+
+    assert(aiohttp.ClientSession.post.call_count == 2)
+    assert(resp == example_submission_response)
+
+def test_retry_delay():
+
+    assert(Vat.retry_delay(0, "7") == 7)
+    assert(Vat.retry_delay(0, "3600") == 30)
+    assert(Vat.retry_delay(0, "Wed, 21 Oct 2015 07:28:00 GMT") == 0)
+    assert(1 <= Vat.retry_delay(0) <= 1.5)
+    assert(Vat.retry_delay(10) == 30)
+
+class MockAuth:
+    def __init__(self, expires):
+        self.auth = dict(example_auth, expires=expires.isoformat())
+        self.refreshes = 0
+
+    def get(self, key):
+        return self.auth[key]
+
+    async def refresh(self, svc):
+        await asyncio.sleep(0)
+        self.refreshes += 1
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=4)
+        self.auth["expires"] = expires.isoformat()
+
+@pytest.mark.asyncio
+async def test_ensure_token_expired():
+
+    vat = create_vat_client()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    vat.auth = MockAuth(now - datetime.timedelta(minutes=1))
+
+    # Concurrent callers share one refresh
+    await asyncio.gather(vat.ensure_token(), vat.ensure_token())
+
+    assert(vat.auth.refreshes == 1)
+    assert(vat.token_expiry() > now + datetime.timedelta(hours=1))
+
+@pytest.mark.asyncio
+async def test_ensure_token_background():
+
+    vat = create_vat_client()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    vat.auth = MockAuth(now + datetime.timedelta(minutes=2))
+
+    # Doesn't wait for the refresh
+    await vat.ensure_token()
+    assert(vat.auth.refreshes == 0)
+
+    await vat.close()
+    assert(vat.auth.refreshes == 1)
+
+    # Token is fresh, nothing more to do
+    await vat.ensure_token()
+    assert(vat.refresh_tasks == {})
+    assert(vat.auth.refreshes == 1)
+
+def test_ensure_token_two_loops():
+
+    class SlowAuth(MockAuth):
+        async def refresh(self, svc):
+            await asyncio.sleep(0.05)
+            await MockAuth.refresh(self, svc)
+
+    vat = create_vat_client()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    vat.auth = SlowAuth(now + datetime.timedelta(minutes=2))
+
+    first = asyncio.new_event_loop()
+    second = asyncio.new_event_loop()
+
+    try:
+
+        # Background refresh started on one loop, which then stops with
+        # the refresh still in flight
+        first.run_until_complete(vat.ensure_token())
+        assert(vat.auth.refreshes == 0)
+
+        # Another loop with an expired token refreshes on its own loop
+        # rather than waiting on the first loop's task
+        vat.auth.auth["expires"] = (
+            now - datetime.timedelta(minutes=1)
+        ).isoformat()
+        second.run_until_complete(vat.ensure_token())
+        assert(vat.auth.refreshes == 1)
+        second.run_until_complete(vat.close())
+
+        # The first loop's refresh is finished off by its own close
+        first.run_until_complete(vat.close())
+        assert(vat.auth.refreshes == 2)
+        assert(vat.refresh_tasks == {})
+
+    finally:
+        first.close()
+        second.close()
+
+@pytest.mark.asyncio
+async def test_auth_collector(unused_tcp_port):
+
+    coll = AuthCollector("localhost", unused_tcp_port)
+    await coll.start()
+
+    url = "http://localhost:%d/auth?code=abc123&state=x" % unused_tcp_port
+    async with aiohttp.ClientSession() as client:
+        async with client.get(url) as resp:
+            assert(resp.status == 200)
+
+    # Result is signalled without polling
+    await asyncio.wait_for(coll.done.wait(), 5)
+    await coll.stop()
+
+    assert(coll.result == { "code": "abc123", "state": "x" })
+
+@pytest.mark.asyncio
+async def test_gather_reads(mocker):
+
+    vat = create_vat_client()
+
+    responses = {
+        "liabilities": example_liabilities,
+        "payments": { "payments": [
+            { "amount": 12.5, "received": "2021-03-04" }
+        ] },
+        "obligations": { "obligations": [] },
+    }
+
+    def get(url, **kwargs):
+        kind = url.split("?")[0].rsplit("/", 1)[1]
+        return MockResponse(responses[kind], 200)
+
+    mocker.patch('aiohttp.ClientSession.get', side_effect=get)
+
+    obls, liabs, pays = await asyncio.gather(
+        vat.get_obligations(example_vrn, example_start, example_end),
+        vat.get_vat_liabilities(example_vrn, example_start, example_end),
+        vat.get_vat_payments(example_vrn, example_start, example_end),
+    )
+
+    # One session for all three
+    assert(len(vat.sessions) == 1)
+
+    await vat.close()
+
+    assert(obls == [])
+    assert(len(liabs) == 2)
+    assert(pays[0].amount == 12.5)
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("streaming", [True, False])
+async def test_get_items_missing_key(mocker, monkeypatch, streaming):
+
+    import gnucash_uk_vat.hmrc as hmrc
+
+    if streaming:
+        pytest.importorskip("ijson")
+    else:
+        monkeypatch.setattr(hmrc, "ijson", None)
+
+    vat = create_vat_client()
+
+    mocker.patch(
+        'aiohttp.ClientSession.get',
+        side_effect=lambda *a, **k: MockResponse(
+            {"code": "SERVER_ERROR", "message": "Broken"}, 200
+        )
+    )
+
+    with pytest.raises(KeyError, match="payments"):
+        await vat.get_vat_payments(example_vrn, example_start, example_end)
+
+    # An empty list is data, not an error
+    mocker.patch(
+        'aiohttp.ClientSession.get',
+        side_effect=lambda *a, **k: MockResponse({"payments": []}, 200)
+    )
+
+    pays = await vat.get_vat_payments(example_vrn, example_start, example_end)
+
+    await vat.close()
+
+    assert(pays == [])
+
+@pytest.mark.asyncio
+async def test_get_open_obligations(mocker):
+
+    vat = create_vat_client()
+
+    resp = MockResponse({ "obligations": [
+        {
+            "periodKey": "#001", "status": "O",
+            "start": "2021-01-01", "end": "2021-03-31", "due": "2021-05-07"
+        }
+    ] }, 200)
+
+    mocker.patch('aiohttp.ClientSession.get', return_value=resp)
+
+    obls = await vat.get_open_obligations(example_vrn)
+
+    await vat.close()
+
+    aiohttp.ClientSession.get.assert_called_once_with(
+        f"{example_api_base}/organisations/vat/918273645/obligations?status=O",
+        headers=expected_headers | {
+            'Accept': 'application/vnd.hmrc.1.0+json'
+        }
+    )
+
+    assert(obls[0].periodKey == "#001")
+    assert(str(obls[0].due) == "2021-05-07")
+
+@pytest.mark.asyncio
+async def test_refresh_token_single_flight(mocker):
+
+    vat = create_vat_client()
+
+    resp = MockResponse({
+        "access_token": "new-access", "refresh_token": "new-refresh",
+        "token_type": "bearer", "expires_in": 14400
+    }, 200)
+
+    mocker.patch('aiohttp.ClientSession.post', return_value=resp)
+
+    a, b = await asyncio.gather(
+        vat.refresh_token("old-refresh"), vat.refresh_token("old-refresh")
+    )
+
+    await vat.close()
+
+    assert(aiohttp.ClientSession.post.call_count == 1)
+    assert(a == b)
+    assert(a["access_token"] == "new-access")
+    assert(a["expires"].endswith("+00:00"))
+    assert("." not in a["expires"])
+    assert(vat.token_requests == {})
+
+def test_token_expiry():
+
+    vat = create_vat_client()
+    utc = datetime.timezone.utc
+
+    # Older auth files store naive UTC times
+    vat.auth = dict(example_auth, expires="2030-01-02T03:04:05")
+    assert(
+        vat.token_expiry() ==
+        datetime.datetime(2030, 1, 2, 3, 4, 5, tzinfo=utc)
+    )
+
+    vat.auth = dict(example_auth, expires="2030-01-02T03:04:05+01:00")
+    assert(
+        vat.token_expiry() ==
+        datetime.datetime(2030, 1, 2, 2, 4, 5, tzinfo=utc)
+    )
+    assert(vat.deadline == vat.token_expiry().timestamp())
+
+    vat.auth = example_auth
+    assert(vat.token_expiry() == None)
+
+def test_create_profiles():
+
+    for prof, cls, base in [
+            ("prod", Vat, "https://api.service.hmrc.gov.uk"),
+            ("test", VatTest, "https://test-api.service.hmrc.gov.uk"),
+            ("local", VatLocalTest, "http://localhost:8080"),
+    ]:
+        vat = create(example_config | { "application.profile": prof },
+                     example_auth, None)
+        assert(type(vat) == cls)
+        assert(vat.api_base == base)
+
+    with pytest.raises(RuntimeError):
+        create({ "application.profile": "nope" }, example_auth, None)
+
+@pytest.mark.asyncio
+async def test_submit_incomplete_return(mocker):
+
+    vat = create_vat_client()
+
+    mocker.patch('aiohttp.ClientSession.post')
+
+    rtn = Return.from_dict(example_return)
+    rtn.netVatDue = None
+
+    with pytest.raises(RuntimeError, match="netVatDue"):
+        await vat.submit_vat_return(example_vrn, rtn)
+
+    rtn = Return.from_dict(example_return)
+    rtn.periodKey = None
+
+    with pytest.raises(RuntimeError, match="period key"):
+        await vat.submit_vat_return(example_vrn, rtn)
+
+    assert(not aiohttp.ClientSession.post.called)
+
+@pytest.mark.asyncio
+async def test_throttle(mocker):
+
+    vat = create_vat_client()
+
+    clock = mocker.patch('time.monotonic', return_value=100.0)
+    sleep = mocker.patch('asyncio.sleep')
+
+    # Three requests a second go straight through, the fourth waits for
+    # the first to leave the window
+    for i in range(4):
+        await vat.throttle()
+
+    assert(sleep.call_count == 1)
+    assert(sleep.call_args.args[0] == pytest.approx(1.0))
+
+    # A Retry-After holds back the next request
+    clock.return_value = 110.0
+    vat.blocked_until = 115.0
+    await vat.throttle()
+    assert(sleep.call_args.args[0] == pytest.approx(5.0))